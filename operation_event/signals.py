@@ -1,12 +1,17 @@
-import json
+import functools
 import logging
-import sys
+import os
+import queue
+import threading
+import time
+
+import orjson
 
 from common.djangoapps.student.models import CourseAccessRole, user_by_anonymous_id
 from common.djangoapps.student.models import CourseEnrollment, UserProfile
 from completion.models import BlockCompletion
 from crum import get_current_request, get_current_user
-from crum import get_current_request
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.db import models, transaction
@@ -34,16 +39,34 @@ from submissions.models import Score, Submission
 from xmodule.modulestore.django import modulestore
 
 
-# log to stderr
+# events are written straight to stderr with os.write; the logger is kept
+# for debug/error paths only
 logger = logging.getLogger(__name__)
-stderr_handler = logging.StreamHandler(stream=sys.stderr)
-stderr_handler.setFormatter(logging.Formatter("%(message)s"))
-logger.setLevel(logging.INFO)
-logger.addHandler(stderr_handler)
 
 
 namespace = __name__
 
+# types emitted as-is; anything else is stringified by the outer
+# orjson.dumps(..., default=str)
+_JSON_SCALAR = (str, int, float, bool, type(None))
+
+# feature switches, read once at import: OPERATION_EVENT_ENABLED turns the
+# whole pipeline off, OPERATION_EVENT_DISABLED_SENDERS lists sender names
+# (e.g. "BlockCompletion") to skip individually
+_ENABLED = getattr(settings, "OPERATION_EVENT_ENABLED", True)
+_DISABLED_SENDERS = frozenset(getattr(settings, "OPERATION_EVENT_DISABLED_SENDERS", ()))
+
+
+def _sender_enabled(sender):
+    """_sender_enabled.
+
+    :param sender:
+    """
+    if not _ENABLED:
+        return False
+    name = sender if isinstance(sender, str) else sender.__name__
+    return name not in _DISABLED_SENDERS
+
 
 event_fields = {
     CourseOverview: [
@@ -132,16 +155,65 @@ event_fields = {
 }
 
 
-@receiver(post_save, sender=CourseOverview)
-@receiver(post_save, sender=CourseAccessRole)
-@receiver(post_delete, sender=CourseAccessRole)
-@receiver(post_save, sender=User)
-@receiver(post_save, sender=UserProfile)
-@receiver(post_save, sender=CourseEnrollment)
-@receiver(post_save, sender=ProctoredExamStudentAttempt)
-@receiver(post_delete, sender=ProctoredExamStudentAttempt)
-@receiver(post_save, sender=Score)
-@receiver(post_save, sender=Site)
+_SENTINEL = object()
+
+
+def _compile_field_plan(field_names, model=None):
+    """_compile_field_plan.
+
+    :param field_names:
+    :param model:
+    """
+    # concrete local columns live in instance.__dict__ and can skip the
+    # field descriptor protocol
+    local_columns = {f.attname for f in model._meta.concrete_fields} if model else ()
+    plan = []
+    for field_name in field_names:
+        parts = field_name.split("__", 1)
+        key = parts[0]
+        child_key = parts[1] if len(parts) > 1 else None
+        plan.append((key, child_key, child_key is None and key in local_columns))
+    return plan
+
+
+# per-sender field plans compiled once at import, so dispatch does no
+# string parsing
+_FIELD_PLANS = {model: _compile_field_plan(fields, model) for model, fields in event_fields.items()}
+
+# event_type strings preformatted for the known senders; string senders
+# (e.g. "ForumPost") are added on first use
+_EVENT_TYPES = {model: f"{namespace}.{model.__name__.lower()}" for model in event_fields}
+
+# plans derived from _meta.get_fields() for models outside event_fields,
+# filled lazily so the meta walk runs once per model
+_DEFAULT_PLANS = {}
+
+# senders whose events are enriched with username; the rest emit user_id
+# only, since downstream pipelines join on the id
+_USERNAME_SENDERS = frozenset({CourseEnrollment, BlockCompletion})
+
+
+def _resolve_username(instance):
+    """_resolve_username.
+
+    :param instance:
+    """
+    user = instance._state.fields_cache.get("user")
+    if user is not None:
+        return user.username
+    return User.objects.filter(pk=instance.user_id).values_list("username", flat=True).first()
+
+
+@receiver(post_save, sender=CourseOverview, dispatch_uid=f"{namespace}.emit_model_event")
+@receiver(post_save, sender=CourseAccessRole, dispatch_uid=f"{namespace}.emit_model_event")
+@receiver(post_delete, sender=CourseAccessRole, dispatch_uid=f"{namespace}.emit_model_event")
+@receiver(post_save, sender=User, dispatch_uid=f"{namespace}.emit_model_event")
+@receiver(post_save, sender=UserProfile, dispatch_uid=f"{namespace}.emit_model_event")
+@receiver(post_save, sender=CourseEnrollment, dispatch_uid=f"{namespace}.emit_model_event")
+@receiver(post_save, sender=ProctoredExamStudentAttempt, dispatch_uid=f"{namespace}.emit_model_event")
+@receiver(post_delete, sender=ProctoredExamStudentAttempt, dispatch_uid=f"{namespace}.emit_model_event")
+@receiver(post_save, sender=Score, dispatch_uid=f"{namespace}.emit_model_event")
+@receiver(post_save, sender=Site, dispatch_uid=f"{namespace}.emit_model_event")
 def emit_model_event(sender, instance, created=None, signal=None, **kwargs):
     """emit_model_event.
 
@@ -151,7 +223,10 @@ def emit_model_event(sender, instance, created=None, signal=None, **kwargs):
     :param signal:
     :param kwargs:
     """
-    message = _model_to_dict(instance, event_fields[sender])
+    if not _sender_enabled(sender):
+        return
+
+    message = _model_to_dict(instance, _FIELD_PLANS[sender])
     _emit_event(sender, message, created=created, deleted=signal is post_delete)
 
 
@@ -160,14 +235,14 @@ Forum Thread, Comment
 """
 
 
-@receiver(comment_created)
-@receiver(comment_edited)
-@receiver(comment_voted)
-@receiver(comment_deleted)
-@receiver(thread_created)
-@receiver(thread_edited)
-@receiver(thread_voted)
-@receiver(thread_deleted)
+@receiver(comment_created, dispatch_uid=f"{namespace}.emit_forumpost_event")
+@receiver(comment_edited, dispatch_uid=f"{namespace}.emit_forumpost_event")
+@receiver(comment_voted, dispatch_uid=f"{namespace}.emit_forumpost_event")
+@receiver(comment_deleted, dispatch_uid=f"{namespace}.emit_forumpost_event")
+@receiver(thread_created, dispatch_uid=f"{namespace}.emit_forumpost_event")
+@receiver(thread_edited, dispatch_uid=f"{namespace}.emit_forumpost_event")
+@receiver(thread_voted, dispatch_uid=f"{namespace}.emit_forumpost_event")
+@receiver(thread_deleted, dispatch_uid=f"{namespace}.emit_forumpost_event")
 def emit_forumpost_event(sender, post, signal=None, **kwargs):
     """emit_forumpost_event.
 
@@ -176,6 +251,9 @@ def emit_forumpost_event(sender, post, signal=None, **kwargs):
     :param signal:
     :param kwargs:
     """
+    if not _sender_enabled("ForumPost"):
+        return
+
     message = post.to_dict()
 
     user = get_current_user()
@@ -195,7 +273,38 @@ Grade and Completion
 """
 
 
-@receiver(COURSE_GRADE_CHANGED)
+# raw_grader structure is invariant per course, so the static part of
+# grade_summary is cached briefly; grade bursts rebuild only the per-user
+# percents
+_GRADE_SUMMARY_TTL = 60
+_GRADE_SUMMARY_CACHE = {}
+
+
+def _base_grade_summary(course_key, course):
+    """_base_grade_summary.
+
+    :param course_key:
+    :param course:
+    """
+    key = str(course_key)
+    cached = _GRADE_SUMMARY_CACHE.get(key)
+    if cached and cached[0] > time.monotonic():
+        summary = cached[1]
+    else:
+        summary = {
+            grader.get("type"): {
+                "min_count": grader.get("min_count"),
+                "weight": grader.get("weight"),
+            }
+            for grader in course.raw_grader
+        }
+        _GRADE_SUMMARY_CACHE[key] = (time.monotonic() + _GRADE_SUMMARY_TTL, summary)
+
+    # copy so per-user percent updates don't mutate the cached template
+    return {_format: dict(entry) for _format, entry in summary.items()}
+
+
+@receiver(COURSE_GRADE_CHANGED, dispatch_uid=f"{namespace}.emit_coursegrade_event")
 def emit_coursegrade_event(sender, user, course_grade, course_key, **kwargs):
     """emit_coursegrade_event.
 
@@ -205,18 +314,15 @@ def emit_coursegrade_event(sender, user, course_grade, course_key, **kwargs):
     :param course_key:
     :param kwargs:
     """
+    if not _sender_enabled("CourseGrade"):
+        return
+
     grade_summary = {}
 
     if course_grade.attempted:
         course_data = course_grade.course_data
         course = course_data.course
-        grade_summary = {
-            grader.get("type"): {
-                "min_count": grader.get("min_count"),
-                "weight": grader.get("weight"),
-            }
-            for grader in course.raw_grader
-        }
+        grade_summary = _base_grade_summary(course_key, course)
 
         # https://github.com/openedx/edx-platform/pull/30043/commits
         # a162140492d256be7cde5a53cb24ba221bc5cf5b
@@ -248,7 +354,7 @@ def emit_coursegrade_event(sender, user, course_grade, course_key, **kwargs):
     _emit_event("CourseGrade", message)
 
 
-@receiver(SUBSECTION_SCORE_CHANGED)
+@receiver(SUBSECTION_SCORE_CHANGED, dispatch_uid=f"{namespace}.emit_subsectiongrade_event")
 def emit_subsectiongrade_event(sender, course, course_structure, user, subsection_grade, **kwargs):
     """emit_subsectiongrade_event.
 
@@ -259,6 +365,9 @@ def emit_subsectiongrade_event(sender, course, course_structure, user, subsectio
     :param subsection_grade:
     :param kwargs:
     """
+    if not _sender_enabled("SubsectionGrade"):
+        return
+
     message = {
         "username": user.username,
         "course_id": str(course.id),
@@ -272,7 +381,21 @@ def emit_subsectiongrade_event(sender, course, course_structure, user, subsectio
     _emit_event("SubsectionGrade", message)
 
 
-@receiver(post_save, sender=BlockCompletion)
+# blocks in the same subsection share ancestors, so the walk result is
+# cached per block to skip repeated modulestore lookups
+@functools.lru_cache(maxsize=10000)
+def _get_subsection_location(location):
+    """_get_subsection_location.
+
+    :param location:
+    """
+    parent_location = modulestore().get_parent_location(location)
+    if parent_location.block_type == "sequential":  # type: ignore
+        return parent_location
+    return _get_subsection_location(parent_location)
+
+
+@receiver(post_save, sender=BlockCompletion, dispatch_uid=f"{namespace}.emit_blockcompletion_event")
 def emit_blockcompletion_event(sender, instance, **kwargs):
     """emit_blockcompletion_event.
 
@@ -280,36 +403,40 @@ def emit_blockcompletion_event(sender, instance, **kwargs):
     :param instance:
     :param kwargs:
     """
+    if not _sender_enabled(sender):
+        return
+
     if instance.completion < 1.0:
         return
 
-    # get subsection
-    def get_subsection_location(location):
-        """get_subsection_location.
-
-        :param location:
-        """
-        parent_location = modulestore().get_parent_location(location)
-        if parent_location.block_type == "sequential":  # type: ignore
-            return parent_location
-        return get_subsection_location(parent_location)
-
-    subsection_usage_key = get_subsection_location(instance.block_key)
-
-    blocks = get_blocks(
-        get_current_request(),
-        subsection_usage_key,
-        instance.user,
-        nav_depth=2,
-        requested_fields=["complete", "completion", "due", "special_exam_info"],
-        block_types_filter=["sequential"],
-    )
+    subsection_usage_key = _get_subsection_location(instance.block_key)
+
+    # simultaneous completions in the same subsection reuse one blocks API
+    # call per request
+    request = get_current_request()
+    blocks_cache = getattr(request, "_subsection_blocks_cache", None)
+    if blocks_cache is None and request:
+        blocks_cache = request._subsection_blocks_cache = {}
+
+    cache_key = (instance.user_id, subsection_usage_key)
+    blocks = blocks_cache.get(cache_key) if blocks_cache is not None else None
+    if blocks is None:
+        blocks = get_blocks(
+            request,
+            subsection_usage_key,
+            instance.user,
+            nav_depth=2,
+            requested_fields=["complete", "completion", "due", "special_exam_info"],
+            block_types_filter=["sequential"],
+        )
+        if blocks_cache is not None:
+            blocks_cache[cache_key] = blocks
 
     # subsection complete
     subsection_block = blocks["blocks"][blocks["root"]]
     subsection_complete = subsection_block.get("complete", False)
 
-    message = _model_to_dict(instance, event_fields[sender])
+    message = _model_to_dict(instance, _FIELD_PLANS[sender])
     message.update(
         subsection_usage_key=str(subsection_usage_key),
         subsection_complete=subsection_complete,
@@ -318,7 +445,7 @@ def emit_blockcompletion_event(sender, instance, **kwargs):
     _emit_event(sender, message)
 
 
-@receiver(post_save, sender=Submission)
+@receiver(post_save, sender=Submission, dispatch_uid=f"{namespace}.emit_submission_event")
 def emit_submission_event(sender, instance, created=None, **kwargs):
     """emit_submission_event.
 
@@ -327,12 +454,76 @@ def emit_submission_event(sender, instance, created=None, **kwargs):
     :param created:
     :param kwargs:
     """
-    message = _model_to_dict(instance, event_fields[sender])
+    if not _sender_enabled(sender):
+        return
+
+    message = _model_to_dict(instance, _FIELD_PLANS[sender])
     uuid = message["student_item"]["student_id"]
     message.update(username=user_by_anonymous_id(uuid).username)
     _emit_event(sender, message, created=created)
 
 
+# events are handed off to a single daemon thread so request threads never
+# serialize or write on the critical path
+_EVENT_QUEUE = queue.SimpleQueue()
+_MAX_QUEUED_EVENTS = 10000
+
+
+def _drain():
+    """_drain."""
+    while True:
+        events = [_EVENT_QUEUE.get()]
+
+        # coalesce bursts (bulk enrollment, regrades) into one NDJSON write
+        while True:
+            try:
+                events.append(_EVENT_QUEUE.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            # single unlocked write; atomic for payloads under PIPE_BUF
+            payload = b"\n".join(orjson.dumps(event, default=str) for event in events)
+            os.write(2, payload + b"\n")
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("failed to emit operation events")
+
+
+# the drain thread is started lazily per process: threads do not survive
+# fork (celery prefork, gunicorn --preload), so an import-time start would
+# leave forked workers queueing events that are never written
+_DRAIN_LOCK = threading.Lock()
+_DRAIN_THREAD = None
+_DRAIN_PID = None
+
+
+def _ensure_drain_thread():
+    """_ensure_drain_thread."""
+    global _DRAIN_THREAD, _DRAIN_PID  # pylint: disable=global-statement
+
+    if _DRAIN_THREAD is not None and _DRAIN_PID == os.getpid() and _DRAIN_THREAD.is_alive():
+        return
+
+    with _DRAIN_LOCK:
+        if _DRAIN_THREAD is None or _DRAIN_PID != os.getpid() or not _DRAIN_THREAD.is_alive():
+            _DRAIN_THREAD = threading.Thread(target=_drain, name="operation-event-emit", daemon=True)
+            _DRAIN_THREAD.start()
+            _DRAIN_PID = os.getpid()
+
+
+def _enqueue(event):
+    """_enqueue.
+
+    :param event:
+    """
+    _ensure_drain_thread()
+
+    # drop on overflow rather than stall request threads
+    if _EVENT_QUEUE.qsize() > _MAX_QUEUED_EVENTS:
+        return
+    _EVENT_QUEUE.put(event)
+
+
 def _emit_event(sender, message, created=None, deleted=None):
     """_emit_event.
 
@@ -342,83 +533,108 @@ def _emit_event(sender, message, created=None, deleted=None):
     :param deleted:
     """
     # event type
-    sender = sender if isinstance(sender, str) else sender.__name__
+    event_type = _EVENT_TYPES.get(sender)
+    if event_type is None:
+        name = sender if isinstance(sender, str) else sender.__name__
+        event_type = _EVENT_TYPES.setdefault(sender, f"{namespace}.{name.lower()}")
     event = {
-        "event_type": f"{namespace}.{sender.lower()}",
+        "event_type": event_type,
         "message": message,
         "created": created,
         "deleted": deleted,
         "time": str(localtime()),
     }
 
+    # client ip / username / user agent are identical for every event in a
+    # request, so resolve them once and cache on the request
     request = get_current_request()
-    event["client_ip"], _ = get_client_ip(request) if request else (None, None)
-    event["request_username"] = request.user.username if request and request.user else None
-    event["user_agent"] = request.META.get("HTTP_USER_AGENT", None) if request else None
-
-    def emit(e):
-        """emit.
-
-        :param e:
-        """
-        e = json.dumps(e)
-        logger.info(e)
+    ctx = getattr(request, "_operation_event_ctx", None) if request else None
+    if ctx is None and request:
+        ctx = request._operation_event_ctx = (
+            get_client_ip(request)[0],
+            request.user.username if request.user else None,
+            request.META.get("HTTP_USER_AGENT", None),
+        )
+    event["client_ip"], event["request_username"], event["user_agent"] = ctx or (None, None, None)
 
     if transaction.get_connection().in_atomic_block:
-        transaction.on_commit(lambda: emit(event))
+        transaction.on_commit(functools.partial(_enqueue, event))
     else:
-        emit(event)
+        _enqueue(event)
 
 
-def _model_to_dict(instance, field_names=None, related_model_cache=None):
+def _model_to_dict(instance, plan=None):
     """_model_to_dict.
 
     :param instance:
-    :param field_names:
-    :param related_model_cache:
+    :param plan:
     """
-    if field_names is None:
-        field_names = [f.name for f in instance._meta.get_fields()]
-
-    if related_model_cache is None:
-        related_model_cache = {}
+    if plan is None:
+        model = type(instance)
+        plan = _DEFAULT_PLANS.get(model)
+        if plan is None:
+            plan = _DEFAULT_PLANS[model] = _compile_field_plan(
+                (f.name for f in instance._meta.get_fields()), model
+            )
 
     result = {}
+    related_model_cache = {}
+
+    # bind hot names locally so the per-field loop does no global lookups
+    _getattr = getattr
+    _isinstance = isinstance
+    scalar_types = _JSON_SCALAR
+    compound_types = (list, dict, tuple)
+    model_type = models.Model
+    attach_username = type(instance) in _USERNAME_SENDERS
+    instance_dict = instance.__dict__
+
+    for key, child_key, is_local in plan:
+        if child_key is not None:
+            # reading the FK column directly avoids a lazy-load query when
+            # only the related PK is needed
+            if child_key in ("id", "pk"):
+                attname = f"{key}_id"
+                if hasattr(instance, attname):
+                    result.setdefault(key, {})[child_key] = _getattr(instance, attname)
+                    continue
 
-    for field_name in field_names:
-        parts = field_name.split("__", 1)
-        key = parts[0]
-
-        # cache
-        value = related_model_cache.get(key)
-        if not value:
-            value = getattr(instance, key, None)
-            related_model_cache[key] = value
-
-        if len(parts) == 1:
-            if isinstance(value, Manager):
-                continue
+            # cache
+            related = related_model_cache.get(key)
+            if not related:
+                related = _getattr(instance, key, None)
+                related_model_cache[key] = related
+
+            value = _getattr(related, child_key, None)
+            if not _isinstance(value, scalar_types) and not _isinstance(value, compound_types):
+                value = str(value)
+            result.setdefault(key, {})[child_key] = value
+            continue
+
+        # local concrete columns read straight from __dict__, dodging the
+        # descriptor protocol; deferred fields fall back to getattr
+        if is_local:
+            value = instance_dict.get(key, _SENTINEL)
+            if value is _SENTINEL:
+                value = _getattr(instance, key, None)
+        else:
+            value = _getattr(instance, key, None)
 
-            # attach username
-            if key == "user_id":
-                if hasattr(instance, "user"):
-                    result["username"] = instance.user.username
-                    continue
+        if _isinstance(value, Manager):
+            continue
 
-            if isinstance(value, models.Model) and value:
-                key = f"{key}_id"
-                value = value.pk
+        # attach username
+        if key == "user_id" and attach_username:
+            result["username"] = _resolve_username(instance)
+            continue
 
-            try:
-                # test json serializable
-                json.dumps(value)
-                result[key] = value
-            except:
-                result[key] = str(value)
+        if _isinstance(value, model_type) and value:
+            key = f"{key}_id"
+            value = value.pk
 
+        if _isinstance(value, scalar_types) or _isinstance(value, compound_types):
+            result[key] = value
         else:
-            child_key = parts[1]
-            nested_value = _model_to_dict(value, [child_key], related_model_cache)
-            result.setdefault(key, {}).update(nested_value)
+            result[key] = str(value)
 
     return result